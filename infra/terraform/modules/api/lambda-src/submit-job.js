@@ -34,8 +34,9 @@ function validateInput(body) {
     errors.push('steps must be a number between 1 and 50');
   }
   
-  if (body.guidanceScale && (typeof body.guidanceScale !== 'number' || body.guidanceScale < 1 || body.guidanceScale > 20)) {
-    errors.push('guidanceScale must be a number between 1 and 20');
+  // Values <= 1 disable classifier-free guidance (one UNet pass per step)
+  if (body.guidanceScale !== undefined && (typeof body.guidanceScale !== 'number' || body.guidanceScale < 0 || body.guidanceScale > 20)) {
+    errors.push('guidanceScale must be a number between 0 and 20');
   }
   
   if (body.width && (typeof body.width !== 'number' || body.width < 256 || body.width > 1024 || body.width % 64 !== 0)) {
@@ -121,8 +122,8 @@ exports.handler = async (event) => {
     // Prepare inference parameters
     const inferenceParams = {
       prompt: body.prompt.trim(),
-      steps: body.steps || 20,
-      guidance_scale: body.guidanceScale || 7.5,
+      steps: body.steps || 10,
+      guidance_scale: body.guidanceScale ?? 7.5,
       width: body.width || 512,
       height: body.height || 512,
       seed: body.seed || Math.floor(Math.random() * 2147483647),
@@ -64,6 +64,8 @@ async function processSuccess(jobId, outputLocation) {
     
     // Common image file patterns from SageMaker output
     const possibleImageKeys = [
+      `${key}/generated_image.jpg`,
+      `${key}/generated_image.webp`,
       `${key}/generated_image.png`,
       `${key}/output.png`,
       `${key}/image.png`,
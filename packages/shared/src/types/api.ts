@@ -38,9 +38,10 @@ export const SubmitJobRequestSchema = z.object({
     .min(1, 'Steps must be at least 1')
     .max(50, 'Steps cannot exceed 50')
     .optional()
-    .default(20),
+    .default(10),
+  // Values <= 1.0 disable classifier-free guidance (one UNet pass per step)
   guidanceScale: z.number()
-    .min(1.0, 'Guidance scale must be at least 1.0')
+    .min(0.0, 'Guidance scale cannot be negative')
     .max(20.0, 'Guidance scale cannot exceed 20.0')
     .optional()
     .default(7.5),
@@ -15,7 +15,7 @@ export const IMAGE_LIMITS = {
   DIMENSION_STEP: 64,
   MIN_STEPS: 1,
   MAX_STEPS: 50,
-  MIN_GUIDANCE_SCALE: 1.0,
+  MIN_GUIDANCE_SCALE: 0.0,
   MAX_GUIDANCE_SCALE: 20.0,
   MAX_PROMPT_LENGTH: 1000,
   MAX_NEGATIVE_PROMPT_LENGTH: 500,
@@ -25,7 +25,7 @@ export const IMAGE_LIMITS = {
 // Default Values
 export const DEFAULTS = {
   MODEL_ID: 'stable-diffusion-xl',
-  STEPS: 20,
+  STEPS: 10,
   GUIDANCE_SCALE: 7.5,
   WIDTH: 1024,
   HEIGHT: 1024,
@@ -165,6 +165,46 @@ describe('Submit Job Handler', () => {
         ]),
       });
     });
+
+    it('should return 400 for negative guidance scale', async () => {
+      mockEvent.body = JSON.stringify({
+        prompt: 'test prompt',
+        guidanceScale: -1,
+      });
+
+      const result = await handler(mockEvent, mockContext);
+
+      expect(result.statusCode).toBe(400);
+      expect(JSON.parse(result.body)).toMatchObject({
+        error: 'Validation failed',
+        details: expect.arrayContaining([
+          expect.objectContaining({
+            message: 'Guidance scale cannot be negative',
+          }),
+        ]),
+      });
+    });
+
+    it.each([0, 0.5])('should accept guidance scale %p to disable classifier-free guidance', async (guidanceScale) => {
+      mockEvent.body = JSON.stringify({
+        prompt: 'test prompt',
+        mode: 'async',
+        guidanceScale,
+      });
+
+      const result = await handler(mockEvent, mockContext);
+
+      expect(result.statusCode).toBe(202);
+      expect(mockDynamoService.prototype.createJob).toHaveBeenCalledWith(
+        expect.objectContaining({
+          inputParams: expect.objectContaining({ guidanceScale }),
+        })
+      );
+      expect(mockSageMakerService.prototype.invokeAsync).toHaveBeenCalledWith(
+        expect.any(String),
+        expect.objectContaining({ guidanceScale })
+      );
+    });
   });
 
   describe('Async Mode', () => {
@@ -372,7 +412,7 @@ describe('Submit Job Handler', () => {
       expect(mockDynamoService.prototype.createJob).toHaveBeenCalledWith(
         expect.objectContaining({
           inputParams: expect.objectContaining({
-            steps: 20, // default
+            steps: 10, // default
             guidanceScale: 7.5, // default
             width: 1024, // default
             height: 1024, // default
@@ -42,8 +42,8 @@ if [ "$2" = "test" ]; then
         -e MAX_STEPS=50 \
         ${ECR_REPO}:${IMAGE_TAG} \
         --prompt "a beautiful sunset over mountains" \
-        --steps 20 \
+        --steps 10 \
         --width 512 \
         --height 512 \
-        --output test_image.png
+        --output test_image.jpg
 fi
\ No newline at end of file
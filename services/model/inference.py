@@ -4,24 +4,42 @@ SageMaker Inference Handler for Stable Diffusion Image Generation
 Supports both synchronous and asynchronous inference modes
 """
 
-import json
 import logging
 import os
 import sys
 import time
 import traceback
 from io import BytesIO
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, Callable, List, Optional, Tuple, Union
 import base64
+import contextlib
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import numpy as np
+import orjson
 from PIL import Image
-from diffusers import StableDiffusionXLPipeline, DPMSolverMultistepScheduler
+from diffusers import AutoencoderKL, StableDiffusionXLPipeline, DPMSolverMultistepScheduler, LCMScheduler
+from diffusers.models.attention_processor import AttnProcessor2_0
 from diffusers.utils import logging as diffusers_logging
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
+try:
+    from diffusers.models.attention_processor import FusedAttnProcessor2_0  # diffusers >= 0.25
+except ImportError:
+    FusedAttnProcessor2_0 = None
+
+try:
+    from torchao.quantization import quantize_, int8_weight_only, float8_dynamic_activation_float8_weight
+except ImportError:
+    quantize_ = None
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -33,6 +51,20 @@ logger = logging.getLogger(__name__)
 # Suppress diffusers warnings
 diffusers_logging.set_verbosity_error()
 
+# Output encodings: format -> (file extension, content type)
+IMAGE_FORMATS = {
+    'JPEG': ('jpg', 'image/jpeg'),
+    'WEBP': ('webp', 'image/webp'),
+    'PNG': ('png', 'image/png'),
+}
+
+# Use TF32 tensor cores for FP32 matmuls/convs and let cuDNN autotune conv
+# kernels; requests are clamped to a small set of shapes so tuning amortizes
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision("high")
+
 class StableDiffusionInferenceHandler:
     """
     SageMaker inference handler for Stable Diffusion XL
@@ -42,20 +74,54 @@ class StableDiffusionInferenceHandler:
         self.pipeline = None
         self.device = None
         self.model_loaded = False
-        self.s3_client = boto3.client('s3')
+        # Split larger images into parallel multipart uploads
+        self._s3_transfer = TransferConfig(multipart_threshold=1024 * 1024, max_concurrency=4, use_threads=True)
         
         # Configuration
         self.model_id = os.environ.get('MODEL_ID', 'stabilityai/stable-diffusion-xl-base-1.0')
-        self.model_cache_root = os.environ.get('MODEL_CACHE_ROOT', '/tmp/model_cache')
+        # FP16-safe SDXL VAE; set VAE_ID to an empty string to use the model's own VAE
+        self.vae_id = os.environ.get('VAE_ID', 'madebyollin/sdxl-vae-fp16-fix')
+        # /opt/ml/model is on the instance volume; /tmp would hold ~7 GB of weights in container memory
+        self.model_cache_root = os.environ.get('MODEL_CACHE_ROOT', '/opt/ml/model')
+        # Half-precision weight files, so FP16 loads skip reading and casting FP32 shards
+        self.model_variant = os.environ.get('MODEL_VARIANT', 'fp16')
         self.max_width = int(os.environ.get('MAX_WIDTH', '1024'))
         self.max_height = int(os.environ.get('MAX_HEIGHT', '1024'))
         self.max_steps = int(os.environ.get('MAX_STEPS', '50'))
-        self.default_steps = int(os.environ.get('DEFAULT_STEPS', '20'))
-        
-        # Create cache directories
-        os.makedirs(self.model_cache_root, exist_ok=True)
-        os.makedirs('/tmp/transformers_cache', exist_ok=True)
-        os.makedirs('/tmp/huggingface_cache', exist_ok=True)
+        # LCM-LoRA distills SDXL to ~4 steps without classifier-free guidance
+        self.use_lcm = os.environ.get('USE_LCM') == '1'
+        self.lcm_lora_id = os.environ.get('LCM_LORA_ID', 'latent-consistency/lcm-lora-sdxl')
+        # Step defaults match the configured scheduler (DPM++ SDE Karras or LCM)
+        self.default_steps = int(os.environ.get('DEFAULT_STEPS', '4' if self.use_lcm else '10'))
+        self.default_guidance_scale = 0.0 if self.use_lcm else 7.5
+        self.output_format = os.environ.get('OUTPUT_FORMAT', 'JPEG').upper()
+        self.output_quality = int(os.environ.get('OUTPUT_QUALITY', '92'))
+        if self.output_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported OUTPUT_FORMAT: {self.output_format}")
+        # Optional width/height buckets (e.g. '512,768,1024') that requests are
+        # snapped to so compiled graphs are reused instead of recompiled per shape.
+        # Off by default: snapping changes the output size the API accepted
+        self.resolution_buckets = self._parse_buckets(os.environ.get('RESOLUTION_BUCKETS', ''))
+        # Step counts whose scheduler timesteps are precomputed at load time
+        self.precompute_steps = self._parse_buckets(os.environ.get('PRECOMPUTE_STEPS', '4,10,20,30'))
+        # UNet post-training quantization via torchao: '' (off), 'int8', 'fp8' or 'auto'
+        self.unet_quantization = os.environ.get('UNET_QUANTIZATION', '').lower()
+        if self.unet_quantization not in ('', 'int8', 'fp8', 'auto'):
+            raise ValueError(f"Unsupported UNET_QUANTIZATION: {self.unet_quantization}")
+        self.low_vram = os.environ.get('LOW_VRAM') == '1'
+        self.attention_slicing = self.low_vram or os.environ.get('ATTN_SLICING') == '1'
+        self.use_xformers = False
+        # Reused across requests for the concurrent image/metadata uploads
+        self._io_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('IO_WORKERS', '4')), thread_name_prefix='sd-io')
+        # LRU of text encoder outputs keyed by prompt text
+        self.prompt_cache_size = int(os.environ.get('PROMPT_CACHE_SIZE', '128'))
+        self._prompt_cache: 'OrderedDict[str, Tuple[torch.Tensor, torch.Tensor]]' = OrderedDict()
+        self._prompt_cache_lock = threading.Lock()
+        # Scheduler state after set_timesteps, keyed by num_inference_steps
+        # (the execution device is fixed per process)
+        self._timesteps_cache: Dict[int, Dict[str, Any]] = {}
+        # Per-thread generators, reseeded in place for each request
+        self._thread_local = threading.local()
         
         logger.info(f"Initialized handler with model_id: {self.model_id}")
         logger.info(f"Cache directory: {self.model_cache_root}")
@@ -65,6 +131,11 @@ class StableDiffusionInferenceHandler:
             logger.info(f"GPU: {torch.cuda.get_device_name(0)}")
             logger.info(f"GPU Memory: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
     
+    @functools.cached_property
+    def s3_client(self):
+        """S3 client, created on first use to keep it off the cold-start path"""
+        return boto3.client('s3')
+    
     def load_model(self) -> None:
         """Load the Stable Diffusion model"""
         if self.model_loaded:
@@ -74,6 +145,11 @@ class StableDiffusionInferenceHandler:
         start_time = time.time()
         
         try:
+            # Create cache directories
+            os.makedirs(self.model_cache_root, exist_ok=True)
+            os.makedirs('/tmp/transformers_cache', exist_ok=True)
+            os.makedirs('/tmp/huggingface_cache', exist_ok=True)
+            
             # Determine device
             if torch.cuda.is_available():
                 self.device = "cuda"
@@ -84,46 +160,111 @@ class StableDiffusionInferenceHandler:
             
             logger.info(f"Using device: {self.device}")
             
+            torch_dtype = torch.float16 if self.device == "cuda" else torch.float32
+            pipeline_kwargs = {}
+            if self.device == "cuda" and self.model_variant:
+                pipeline_kwargs['variant'] = self.model_variant
+            
+            # The stock SDXL VAE overflows in FP16, so diffusers upcasts it to FP32
+            # for every decode; the fp16-fix VAE stays in FP16 end-to-end
+            if self.device == "cuda" and self.vae_id:
+                pipeline_kwargs['vae'] = AutoencoderKL.from_pretrained(
+                    self.vae_id,
+                    torch_dtype=torch_dtype,
+                    cache_dir=self.model_cache_root,
+                    low_cpu_mem_usage=True
+                )
+                logger.info(f"Using VAE: {self.vae_id}")
+            
             # Load pipeline
             self.pipeline = StableDiffusionXLPipeline.from_pretrained(
                 self.model_id,
-                torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
+                torch_dtype=torch_dtype,
                 use_safetensors=True,
+                low_cpu_mem_usage=True,
                 cache_dir=self.model_cache_root,
-                local_files_only=False
+                local_files_only=False,
+                **pipeline_kwargs
             )
             
-            # Move to device
-            self.pipeline = self.pipeline.to(self.device)
+            if 'vae' in pipeline_kwargs:
+                self.pipeline.vae.register_to_config(force_upcast=False)
             
             # Optimize for inference
-            if self.device == "cuda":
-                # Enable memory efficient attention
-                self.pipeline.enable_attention_slicing()
+            if self.device == "cuda" and self.low_vram:
+                # Trade latency for memory on small GPUs: weights are shuttled
+                # CPU<->GPU per component instead of staying resident
                 self.pipeline.enable_model_cpu_offload()
+                logger.info("LOW_VRAM enabled: using model CPU offload")
+            else:
+                # Keep the whole pipeline resident on the device
+                self.pipeline = self.pipeline.to(self.device)
+            
+            if self.device == "cuda":
+                # channels_last lets the conv-heavy UNet/VAE use faster cuDNN kernels
+                self.pipeline.unet.to(memory_format=torch.channels_last)
+                self.pipeline.vae.to(memory_format=torch.channels_last)
                 
-                # Use DPM++ scheduler for better quality/speed tradeoff
-                self.pipeline.scheduler = DPMSolverMultistepScheduler.from_config(
-                    self.pipeline.scheduler.config
-                )
+                if self.attention_slicing:
+                    # Sequential attention chunks: lower peak memory, ~20% slower
+                    self.pipeline.enable_attention_slicing()
+                    logger.info("Attention slicing enabled")
+                elif self._flash_sdp_available():
+                    # Fused PyTorch 2 scaled_dot_product_attention
+                    self.pipeline.unet.set_attn_processor(AttnProcessor2_0())
+                    torch.backends.cuda.enable_flash_sdp(True)
+                    torch.backends.cuda.enable_mem_efficient_sdp(True)
+                else:
+                    # No flash SDPA on this GPU/PyTorch build: use xformers' fused
+                    # memory-efficient kernel rather than SDPA's math fallback
+                    try:
+                        self.pipeline.enable_xformers_memory_efficient_attention()
+                        self.use_xformers = True
+                        logger.info("Flash SDPA unavailable, using xformers memory-efficient attention")
+                    except Exception as e:
+                        logger.warning(f"Could not enable xformers attention: {e}")
+                        self.pipeline.unet.set_attn_processor(AttnProcessor2_0())
                 
-                # Compile model for faster inference (PyTorch 2.0+)
-                try:
-                    self.pipeline.unet = torch.compile(self.pipeline.unet, mode="reduce-overhead")
-                    logger.info("Model compiled for faster inference")
-                except Exception as e:
-                    logger.warning(f"Could not compile model: {e}")
+                if self.use_lcm:
+                    self.pipeline.load_lora_weights(self.lcm_lora_id, cache_dir=self.model_cache_root)
+                    self.pipeline.fuse_lora()
+                    self.pipeline.scheduler = LCMScheduler.from_config(self.pipeline.scheduler.config)
+                    logger.info(f"Using LCM scheduler with LoRA: {self.lcm_lora_id}")
+                else:
+                    # DPM++ SDE Karras: comparable quality in half the steps of plain DPM++
+                    self.pipeline.scheduler = DPMSolverMultistepScheduler.from_config(
+                        self.pipeline.scheduler.config,
+                        use_karras_sigmas=True,
+                        algorithm_type="sde-dpmsolver++"
+                    )
+                
+                # Merge to_q/to_k/to_v into one GEMM per attention block; done
+                # after LoRA fusing, and only on the SDPA path since it needs the
+                # fused SDPA processor
+                if not self.attention_slicing and not self.use_xformers:
+                    self._fuse_qkv_projections()
+                
+                if self.unet_quantization:
+                    self._quantize_unet()
+                
+                # Compile model for faster inference (PyTorch 2.0+). Skipped with
+                # CPU offload: its hooks move weights inside forward, which breaks
+                # fullgraph tracing and CUDA graph replay
+                if self.low_vram:
+                    logger.info("LOW_VRAM enabled: skipping torch.compile")
+                else:
+                    self._compile_components()
+                
+                # Resolve timesteps once per step bucket instead of per request
+                self._cache_scheduler_timesteps()
             
             # Warm up the pipeline
-            logger.info("Warming up pipeline...")
-            warmup_prompt = "a simple test image"
-            _ = self.pipeline(
-                warmup_prompt,
-                num_inference_steps=1,
-                width=512,
-                height=512,
-                guidance_scale=1.0
-            )
+            self._warmup()
+            
+            # SDXL base zeroes the embeddings for an empty negative prompt; models
+            # that don't encode "" instead, so precompute it once
+            if not self.pipeline.config.force_zeros_for_empty_prompt:
+                self._encode_text('')
             
             self.model_loaded = True
             load_time = time.time() - start_time
@@ -140,6 +281,238 @@ class StableDiffusionInferenceHandler:
             logger.error(traceback.format_exc())
             raise
     
+    def _cache_scheduler_timesteps(self) -> None:
+        """Memoize scheduler.set_timesteps per step count and precompute common step counts
+        
+        The pipeline calls set_timesteps on every request, which rebuilds the
+        sigma schedule in numpy and copies the timesteps to the GPU. On a cache
+        hit the scheduler state captured after the first call is restored.
+        """
+        scheduler = self.pipeline.scheduler
+        set_timesteps = scheduler.set_timesteps
+        
+        def snapshot() -> Dict[str, Any]:
+            # Lists (e.g. model_outputs) are mutated in place by step(), so copy them
+            return {
+                name: list(value) if isinstance(value, list) else value
+                for name, value in vars(scheduler).items()
+                if name != 'set_timesteps'
+            }
+        
+        def cached_set_timesteps(num_inference_steps: Optional[int] = None, device=None, **kwargs) -> None:
+            if kwargs:
+                return set_timesteps(num_inference_steps, device=device, **kwargs)
+            key = num_inference_steps
+            if key not in self._timesteps_cache:
+                set_timesteps(num_inference_steps, device=device)
+                self._timesteps_cache[key] = snapshot()
+            scheduler.__dict__.update({
+                name: list(value) if isinstance(value, list) else value
+                for name, value in self._timesteps_cache[key].items()
+            })
+        
+        scheduler.set_timesteps = cached_set_timesteps
+        
+        for steps in sorted(set(self.precompute_steps + [self.default_steps])):
+            if steps <= self.max_steps:
+                # Same device the pipeline passes, so the cached tensors match
+                scheduler.set_timesteps(steps, device=self.pipeline._execution_device)
+        logger.info(f"Cached scheduler timesteps for {len(self._timesteps_cache)} step counts")
+    
+    def _fuse_qkv_projections(self) -> None:
+        """Fuse the UNet and VAE attention QKV projections and switch them to the fused processor
+        
+        Requires diffusers >= 0.25; the pinned 0.24 has no QKV fusion, so this
+        is a no-op there.
+        """
+        if FusedAttnProcessor2_0 is None or not hasattr(self.pipeline.unet, 'fuse_qkv_projections'):
+            logger.info("QKV projection fusion not supported by the installed diffusers, skipping")
+            return
+        
+        for name in ('unet', 'vae'):
+            model = getattr(self.pipeline, name)
+            try:
+                model.fuse_qkv_projections()
+                # Without the fused processor the packed to_qkv weights would go unused
+                model.set_attn_processor(FusedAttnProcessor2_0())
+                logger.info(f"Fused {name} QKV projections")
+            except Exception as e:
+                logger.warning(f"Could not fuse {name} QKV projections: {e}")
+    
+    def _quantize_unet(self) -> None:
+        """Quantize the UNet's linear layers with torchao before compilation
+        
+        Only nn.Linear weights are quantized; convolutions, normalization and
+        the attention softmax stay in FP16.
+        """
+        if quantize_ is None:
+            logger.warning("UNET_QUANTIZATION set but torchao is not installed, skipping")
+            return
+        
+        mode = self.unet_quantization
+        if mode == 'auto':
+            # FP8 tensor cores need Ada/Hopper (SM89+); INT8 weight-only works from SM80
+            mode = 'fp8' if torch.cuda.get_device_capability() >= (8, 9) else 'int8'
+        
+        config = float8_dynamic_activation_float8_weight() if mode == 'fp8' else int8_weight_only()
+        
+        try:
+            quantize_(self.pipeline.unet, config)
+            logger.info(f"UNet quantized with torchao ({mode})")
+        except Exception as e:
+            logger.warning(f"Could not quantize UNet: {e}")
+    
+    def _compile_components(self) -> None:
+        """Compile the UNet, VAE decoder and text encoders, each falling back to eager on failure
+        
+        torch.compile is lazy, so each component is called on dummy inputs at
+        every warmup shape (with and without CFG for the UNet); tracing errors
+        (e.g. graph breaks under fullgraph) surface here and only that
+        component reverts to eager.
+        """
+        pipeline = self.pipeline
+        shapes = self._warmup_shapes()
+        dtype = pipeline.unet.dtype
+        unet_batches = sorted({2 if self.default_guidance_scale > 1.0 else 1, 1})
+        
+        def probe_unet() -> None:
+            for width, height in shapes:
+                for batch in unet_batches:
+                    pipeline.unet(
+                        torch.randn(
+                            batch, pipeline.unet.config.in_channels, height // 8, width // 8,
+                            device=self.device, dtype=dtype
+                        ),
+                        torch.tensor(999, device=self.device),
+                        encoder_hidden_states=torch.randn(
+                            batch, pipeline.tokenizer.model_max_length, pipeline.unet.config.cross_attention_dim,
+                            device=self.device, dtype=dtype
+                        ),
+                        timestep_cond=None,
+                        cross_attention_kwargs=None,
+                        added_cond_kwargs={
+                            'text_embeds': torch.randn(
+                                batch, pipeline.text_encoder_2.config.projection_dim, device=self.device, dtype=dtype
+                            ),
+                            'time_ids': torch.tensor(
+                                [[height, width, 0, 0, height, width]] * batch, device=self.device, dtype=dtype
+                            )
+                        },
+                        return_dict=False
+                    )
+        
+        def probe_vae() -> None:
+            for width, height in shapes:
+                latents = torch.randn(
+                    1, pipeline.vae.config.latent_channels, height // 8, width // 8,
+                    device=self.device, dtype=pipeline.vae.dtype
+                )
+                pipeline.vae.decode(latents, return_dict=False)
+        
+        self._compile_component(pipeline, 'unet', 'UNet', probe_unet, mode="reduce-overhead", fullgraph=True)
+        self._compile_component(pipeline.vae, 'decode', 'VAE decoder', probe_vae, mode="reduce-overhead", fullgraph=True)
+        
+        for name, tokenizer_name in (('text_encoder', 'tokenizer'), ('text_encoder_2', 'tokenizer_2')):
+            tokenizer = getattr(pipeline, tokenizer_name)
+            input_ids = tokenizer(
+                "", padding="max_length", max_length=tokenizer.model_max_length, truncation=True, return_tensors="pt"
+            ).input_ids.to(self.device)
+            self._compile_component(
+                pipeline, name, name,
+                lambda name=name, input_ids=input_ids: getattr(pipeline, name)(input_ids, output_hidden_states=True),
+                mode="reduce-overhead"
+            )
+    
+    def _compile_component(self, owner: Any, attr: str, label: str, probe: Callable[[], Any], **compile_kwargs) -> None:
+        """Replace owner.attr with its compiled version, keeping eager if compiling or probing fails"""
+        eager = getattr(owner, attr)
+        try:
+            setattr(owner, attr, torch.compile(eager, **compile_kwargs))
+            with torch.inference_mode(), self._sdp_context():
+                probe()
+            logger.info(f"{label} compiled for faster inference")
+        except Exception as e:
+            setattr(owner, attr, eager)
+            logger.warning(f"Could not compile {label}, using eager mode: {e}")
+    
+    @staticmethod
+    def _flash_sdp_available() -> bool:
+        """Whether PyTorch's flash SDPA kernel can run on this GPU (SM80+)"""
+        return torch.backends.cuda.flash_sdp_enabled() and torch.cuda.get_device_capability() >= (8, 0)
+    
+    def _sdp_context(self):
+        """Restrict SDPA to the fused flash / memory-efficient kernels on CUDA"""
+        if self.device != "cuda" or self.attention_slicing or self.use_xformers:
+            return contextlib.nullcontext()
+        return torch.backends.cuda.sdp_kernel(enable_flash=True, enable_math=False, enable_mem_efficient=True)
+    
+    @staticmethod
+    def _parse_buckets(value: str) -> List[int]:
+        """Parse a comma-separated list of bucket sizes"""
+        return sorted(int(v) for v in value.split(',') if v.strip())
+    
+    @staticmethod
+    def _snap_to_bucket(value: int, buckets: List[int], upper: int) -> int:
+        """Snap value to the nearest bucket not above upper (ties go up)"""
+        candidates = [b for b in buckets if b <= upper]
+        if not candidates:
+            return value
+        return min(candidates, key=lambda b: (abs(b - value), -b))
+    
+    def _warmup_shapes(self) -> List[Tuple[int, int]]:
+        """Shapes to warm up at, largest first
+        
+        With resolution buckets this is every (width, height) combination requests
+        can snap to; otherwise the maximum size plus the common 768/512 squares.
+        """
+        widths = [b for b in self.resolution_buckets if b <= self.max_width]
+        heights = [b for b in self.resolution_buckets if b <= self.max_height]
+        if not widths or not heights:
+            max_shape = ((self.max_width // 64) * 64, (self.max_height // 64) * 64)
+            squares = [(size, size) for size in (768, 512) if size < min(max_shape)]
+            return [max_shape] + squares
+        shapes = [(width, height) for width in widths for height in heights]
+        return sorted(shapes, key=lambda shape: shape[0] * shape[1], reverse=True)
+    
+    def _warmup(self) -> None:
+        """Run the pipeline at serving shapes so compilation happens before the first request"""
+        logger.info("Warming up pipeline...")
+        warmup_prompt = "a simple test image"
+        total_start = time.time()
+        
+        if self.device != "cuda":
+            _ = self.pipeline(
+                warmup_prompt,
+                num_inference_steps=1,
+                width=512,
+                height=512,
+                guidance_scale=1.0
+            )
+            return
+        
+        # Match the arguments generate_image uses (empty negative prompt) so Dynamo
+        # captures the graphs served at runtime. Each resolution bucket and CFG
+        # on/off (UNet batch doubles with CFG) is a distinct UNet shape
+        guidance_scales = sorted({self.default_guidance_scale, 0.0}, reverse=True)
+        for width, height in self._warmup_shapes():
+            for guidance_scale in guidance_scales:
+                warmup_start = time.time()
+                with torch.inference_mode(), self._sdp_context():
+                    _ = self.pipeline(
+                        prompt=warmup_prompt,
+                        negative_prompt=None,
+                        num_inference_steps=2,
+                        guidance_scale=guidance_scale,
+                        width=width,
+                        height=height,
+                        num_images_per_prompt=1
+                    )
+                logger.info(
+                    f"Warmup at {width}x{height}, guidance {guidance_scale} "
+                    f"took {time.time() - warmup_start:.2f} seconds"
+                )
+        logger.info(f"Warmup finished in {time.time() - total_start:.2f} seconds")
+    
     def validate_input(self, input_data: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
         """Validate and normalize input parameters"""
         
@@ -161,7 +534,7 @@ class StableDiffusionInferenceHandler:
         # Validate and set defaults
         params = {
             'num_inference_steps': min(max(parameters.get('num_inference_steps', self.default_steps), 1), self.max_steps),
-            'guidance_scale': max(min(parameters.get('guidance_scale', 7.5), 20.0), 1.0),
+            'guidance_scale': max(min(parameters.get('guidance_scale', self.default_guidance_scale), 20.0), 0.0),
             'width': min(max(parameters.get('width', 1024), 256), self.max_width),
             'height': min(max(parameters.get('height', 1024), 256), self.max_height),
             'seed': parameters.get('seed', None),
@@ -173,6 +546,22 @@ class StableDiffusionInferenceHandler:
         params['width'] = (params['width'] // 64) * 64
         params['height'] = (params['height'] // 64) * 64
         
+        # Snap to canonical buckets so warmed-up graphs are reused; the requested
+        # size is kept in the parameters (and so the metadata) when it changes
+        requested_size = (params['width'], params['height'])
+        params['width'] = self._snap_to_bucket(params['width'], self.resolution_buckets, self.max_width)
+        params['height'] = self._snap_to_bucket(params['height'], self.resolution_buckets, self.max_height)
+        if (params['width'], params['height']) != requested_size:
+            params['requested_width'], params['requested_height'] = requested_size
+            logger.info(
+                f"Snapped size {requested_size[0]}x{requested_size[1]} to {params['width']}x{params['height']}"
+            )
+        
+        # guidance_scale <= 1.0 means no classifier-free guidance; normalize to 0.0
+        # so the pipeline skips the unconditional UNet pass
+        if params['guidance_scale'] <= 1.0:
+            params['guidance_scale'] = 0.0
+        
         # Set seed if provided
         if params['seed'] is not None:
             if not isinstance(params['seed'], int) or params['seed'] < 0:
@@ -183,22 +572,93 @@ class StableDiffusionInferenceHandler:
     
     def generate_image(self, prompt: str, parameters: Dict[str, Any]) -> Tuple[Image.Image, Dict[str, Any]]:
         """Generate image using Stable Diffusion"""
+        return self.generate_images([(prompt, parameters)])[0]
+    
+    def _get_generators(self, count: int) -> List[torch.Generator]:
+        """Return count reusable generators owned by the calling thread"""
+        generators = getattr(self._thread_local, 'generators', None)
+        if generators is None:
+            generators = self._thread_local.generators = []
+        while len(generators) < count:
+            generators.append(torch.Generator(device=self.device))
+        return generators[:count]
+    
+    def _encode_text(self, text: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return (prompt_embeds, pooled_prompt_embeds) for text, LRU-cached"""
+        with self._prompt_cache_lock:
+            cached = self._prompt_cache.get(text)
+            if cached is not None:
+                self._prompt_cache.move_to_end(text)
+                return cached
         
-        logger.info(f"Generating image with prompt: '{prompt[:100]}...' if len(prompt) > 100 else prompt")
+        with torch.inference_mode():
+            prompt_embeds, _, pooled_prompt_embeds, _ = self.pipeline.encode_prompt(
+                prompt=text,
+                device=self.device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=False
+            )
+        
+        # Clone: compiled text encoders reuse their CUDA graph output buffers
+        encoded = (prompt_embeds.clone(), pooled_prompt_embeds.clone())
+        if self.prompt_cache_size > 0:
+            with self._prompt_cache_lock:
+                self._prompt_cache[text] = encoded
+                while len(self._prompt_cache) > self.prompt_cache_size:
+                    self._prompt_cache.popitem(last=False)
+        return encoded
+    
+    def generate_images(self, requests: List[Tuple[str, Dict[str, Any]]]) -> List[Tuple[Image.Image, Dict[str, Any]]]:
+        """Generate one image per (prompt, parameters) pair in a single pipeline call
+        
+        All requests must share num_inference_steps, width, height, guidance_scale
+        and whether a negative prompt is set.
+        """
+        prompts = [prompt for prompt, _ in requests]
+        parameters = requests[0][1]
+        
+        logger.info(f"Generating {len(prompts)} image(s), first prompt: '{prompts[0][:100]}'")
         start_time = time.time()
         
         try:
-            # Set random seed if provided
+            # Set random seeds if provided; unseeded requests in the batch get a random one
             generator = None
-            if parameters['seed'] is not None:
-                generator = torch.Generator(device=self.device).manual_seed(parameters['seed'])
-                logger.info(f"Using seed: {parameters['seed']}")
+            if any(params['seed'] is not None for _, params in requests):
+                generator = self._get_generators(len(requests))
+                for gen, (_, params) in zip(generator, requests):
+                    if params['seed'] is not None:
+                        gen.manual_seed(params['seed'])
+                        logger.info(f"Using seed: {params['seed']}")
+                    else:
+                        gen.seed()
             
-            # Generate image
-            with torch.inference_mode():
+            # Reuse text encoder outputs for repeated prompts
+            encoded = [self._encode_text(prompt) for prompt in prompts]
+            prompt_embeds = torch.cat([embeds for embeds, _ in encoded])
+            pooled_prompt_embeds = torch.cat([pooled for _, pooled in encoded])
+            
+            # Leaving the negative embeddings unset makes SDXL zero them out
+            # without running the text encoders; without CFG they are never used
+            do_classifier_free_guidance = parameters['guidance_scale'] > 1.0
+            negative_encoded = None
+            if do_classifier_free_guidance and parameters['negative_prompt']:
+                negative_encoded = [self._encode_text(params['negative_prompt']) for _, params in requests]
+            elif do_classifier_free_guidance and not self.pipeline.config.force_zeros_for_empty_prompt:
+                negative_encoded = [self._encode_text('')] * len(requests)
+            
+            negative_prompt_embeds = None
+            negative_pooled_prompt_embeds = None
+            if negative_encoded is not None:
+                negative_prompt_embeds = torch.cat([embeds for embeds, _ in negative_encoded])
+                negative_pooled_prompt_embeds = torch.cat([pooled for _, pooled in negative_encoded])
+            
+            # Generate images
+            with torch.inference_mode(), self._sdp_context():
                 result = self.pipeline(
-                    prompt=prompt,
-                    negative_prompt=parameters['negative_prompt'] if parameters['negative_prompt'] else None,
+                    prompt_embeds=prompt_embeds,
+                    pooled_prompt_embeds=pooled_prompt_embeds,
+                    negative_prompt_embeds=negative_prompt_embeds,
+                    negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
                     num_inference_steps=parameters['num_inference_steps'],
                     guidance_scale=parameters['guidance_scale'],
                     width=parameters['width'],
@@ -207,53 +667,83 @@ class StableDiffusionInferenceHandler:
                     num_images_per_prompt=parameters['num_images_per_prompt']
                 )
             
-            image = result.images[0]
             generation_time = time.time() - start_time
             
             # Prepare metadata
-            metadata = {
-                'prompt': prompt,
-                'parameters': parameters,
-                'generation_time_seconds': round(generation_time, 2),
-                'model_id': self.model_id,
-                'device': self.device,
-                'timestamp': time.time()
-            }
+            outputs = []
+            for (prompt, params), image in zip(requests, result.images):
+                metadata = {
+                    'prompt': prompt,
+                    'parameters': params,
+                    'generation_time_seconds': round(generation_time, 2),
+                    'batch_size': len(requests),
+                    'model_id': self.model_id,
+                    'device': self.device,
+                    'timestamp': time.time()
+                }
+                outputs.append((image, metadata))
             
-            logger.info(f"Image generated successfully in {generation_time:.2f} seconds")
-            return image, metadata
+            logger.info(f"{len(outputs)} image(s) generated successfully in {generation_time:.2f} seconds")
+            return outputs
             
         except Exception as e:
             logger.error(f"Error generating image: {e}")
             logger.error(traceback.format_exc())
             raise
     
+    def encode_image(self, image: Image.Image) -> BytesIO:
+        """Encode image in the configured OUTPUT_FORMAT, returned as a buffer rewound to 0"""
+        # Single-pass encoders: no optimize search for PNG
+        img_buffer = BytesIO()
+        if self.output_format == 'PNG':
+            image.save(img_buffer, format='PNG', compress_level=1, optimize=False)
+        else:
+            image.save(img_buffer, format=self.output_format, quality=self.output_quality)
+        img_buffer.seek(0)
+        return img_buffer
+    
     def save_image_to_s3(self, image: Image.Image, bucket: str, key: str) -> str:
         """Save image to S3 and return the S3 URI"""
         try:
-            # Convert image to bytes
-            img_buffer = BytesIO()
-            image.save(img_buffer, format='PNG', optimize=True)
-            img_buffer.seek(0)
-            
             # Upload to S3
+            self.s3_client.upload_fileobj(
+                self.encode_image(image),
+                bucket,
+                key,
+                ExtraArgs={
+                    'ContentType': IMAGE_FORMATS[self.output_format][1],
+                    'Metadata': {
+                        'generated-by': 'stable-diffusion-xl',
+                        'timestamp': str(int(time.time()))
+                    }
+                },
+                Config=self._s3_transfer
+            )
+            
+            s3_uri = f"s3://{bucket}/{key}"
+            logger.info(f"Image saved to S3: {s3_uri}")
+            return s3_uri
+            
+        except (ClientError, S3UploadFailedError) as e:
+            logger.error(f"Failed to save image to S3: {e}")
+            raise
+    
+    def save_metadata_to_s3(self, metadata: Dict[str, Any], bucket: str, key: str) -> str:
+        """Save generation metadata as JSON to S3 and return the S3 URI"""
+        try:
             self.s3_client.put_object(
                 Bucket=bucket,
                 Key=key,
-                Body=img_buffer.getvalue(),
-                ContentType='image/png',
-                Metadata={
-                    'generated-by': 'stable-diffusion-xl',
-                    'timestamp': str(int(time.time()))
-                }
+                Body=orjson.dumps(metadata, option=orjson.OPT_INDENT_2),
+                ContentType='application/json'
             )
             
             s3_uri = f"s3://{bucket}/{key}"
-            logger.info(f"Image saved to S3: {s3_uri}")
+            logger.info(f"Metadata saved to S3: {s3_uri}")
             return s3_uri
             
         except ClientError as e:
-            logger.error(f"Failed to save image to S3: {e}")
+            logger.error(f"Failed to save metadata to S3: {e}")
             raise
     
     def process_request(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
@@ -280,33 +770,28 @@ class StableDiffusionInferenceHandler:
                     bucket = s3_parts[0]
                     prefix = s3_parts[1] if len(s3_parts) > 1 else ''
                     
-                    # Save image
-                    image_key = f"{prefix}/generated_image.png"
-                    image_s3_uri = self.save_image_to_s3(image, bucket, image_key)
-                    
-                    # Save metadata
+                    image_key = f"{prefix}/generated_image.{IMAGE_FORMATS[self.output_format][0]}"
                     metadata_key = f"{prefix}/metadata.json"
-                    metadata_json = json.dumps(metadata, indent=2)
-                    self.s3_client.put_object(
-                        Bucket=bucket,
-                        Key=metadata_key,
-                        Body=metadata_json,
-                        ContentType='application/json'
-                    )
+                    
+                    # Encode and upload image and metadata concurrently on the shared
+                    # I/O pool. Both must finish before returning: the callback Lambda
+                    # reads them as soon as SageMaker reports the request complete
+                    image_future = self._io_pool.submit(self.save_image_to_s3, image, bucket, image_key)
+                    metadata_future = self._io_pool.submit(self.save_metadata_to_s3, metadata, bucket, metadata_key)
+                    image_s3_uri = image_future.result()
+                    metadata_s3_uri = metadata_future.result()
                     
                     return {
                         'image_s3_uri': image_s3_uri,
-                        'metadata_s3_uri': f"s3://{bucket}/{metadata_key}",
+                        'metadata_s3_uri': metadata_s3_uri,
                         'metadata': metadata
                     }
             
-            # For sync inference, return base64 encoded image
-            img_buffer = BytesIO()
-            image.save(img_buffer, format='PNG')
-            img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-            
+            # For sync inference, return the encoded image; output_fn either
+            # sends it as-is or base64-encodes it into the JSON response
             return {
-                'generated_image': img_base64,
+                'image': self.encode_image(image),
+                'content_type': IMAGE_FORMATS[self.output_format][1],
                 'metadata': metadata
             }
             
@@ -315,21 +800,29 @@ class StableDiffusionInferenceHandler:
             logger.error(traceback.format_exc())
             raise
 
-# Global handler instance
-handler = StableDiffusionInferenceHandler()
+# Global handler instance, created on first use
+_handler: Optional[StableDiffusionInferenceHandler] = None
+
+def get_handler() -> StableDiffusionInferenceHandler:
+    """Return the process-wide handler, creating it on first call"""
+    global _handler
+    if _handler is None:
+        _handler = StableDiffusionInferenceHandler()
+    return _handler
 
 def model_fn(model_dir: str) -> StableDiffusionInferenceHandler:
     """Load model for SageMaker"""
     logger.info(f"Loading model from directory: {model_dir}")
+    handler = get_handler()
     handler.load_model()
     return handler
 
-def input_fn(request_body: str, content_type: str = 'application/json') -> Dict[str, Any]:
+def input_fn(request_body: Union[str, bytes], content_type: str = 'application/json') -> Dict[str, Any]:
     """Parse input data"""
     logger.info(f"Received request with content_type: {content_type}")
     
     if content_type == 'application/json':
-        return json.loads(request_body)
+        return orjson.loads(request_body)
     else:
         raise ValueError(f"Unsupported content type: {content_type}")
 
@@ -337,10 +830,26 @@ def predict_fn(input_data: Dict[str, Any], model: StableDiffusionInferenceHandle
     """Run inference"""
     return model.process_request(input_data)
 
-def output_fn(prediction: Dict[str, Any], accept: str = 'application/json') -> str:
-    """Format output"""
+def output_fn(prediction: Dict[str, Any], accept: str = 'application/json') -> Union[str, bytes]:
+    """Format output
+    
+    Sync predictions can be returned as raw image bytes by requesting the
+    configured image content type (e.g. 'image/jpeg'), skipping base64.
+    """
+    image_buffer = prediction.get('image')
+    
+    if image_buffer is not None and accept == prediction['content_type']:
+        return image_buffer.getvalue()
+    
     if accept == 'application/json':
-        return json.dumps(prediction)
+        if image_buffer is not None:
+            prediction = {
+                # b64encode reads the buffer directly, without an extra copy
+                'generated_image': base64.b64encode(image_buffer.getbuffer()).decode('ascii'),
+                'content_type': prediction['content_type'],
+                'metadata': prediction['metadata']
+            }
+        return orjson.dumps(prediction)
     else:
         raise ValueError(f"Unsupported accept type: {accept}")
 
@@ -350,11 +859,11 @@ if __name__ == "__main__":
     
     parser = argparse.ArgumentParser(description='Test Stable Diffusion Inference')
     parser.add_argument('--prompt', type=str, required=True, help='Text prompt for image generation')
-    parser.add_argument('--steps', type=int, default=20, help='Number of inference steps')
+    parser.add_argument('--steps', type=int, default=10, help='Number of inference steps')
     parser.add_argument('--width', type=int, default=1024, help='Image width')
     parser.add_argument('--height', type=int, default=1024, help='Image height')
     parser.add_argument('--seed', type=int, help='Random seed')
-    parser.add_argument('--output', type=str, default='test_output.png', help='Output file path')
+    parser.add_argument('--output', type=str, default='test_output.jpg', help='Output file path')
     
     args = parser.parse_args()
     
@@ -370,13 +879,12 @@ if __name__ == "__main__":
     }
     
     try:
-        result = handler.process_request(test_input)
+        result = get_handler().process_request(test_input)
         
-        if 'generated_image' in result:
-            # Decode and save image
-            img_data = base64.b64decode(result['generated_image'])
+        if 'image' in result:
+            # Save encoded image
             with open(args.output, 'wb') as f:
-                f.write(img_data)
+                f.write(result['image'].getvalue())
             print(f"Image saved to {args.output}")
         
         print(f"Generation completed in {result['metadata']['generation_time_seconds']} seconds")